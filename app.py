@@ -1,11 +1,176 @@
+import hashlib
 import os
-import io
-import zipfile
+import re
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+
 import google.generativeai as genai
-from flask import Flask, request, send_file, jsonify
+import orjson
+from google.api_core import exceptions as google_exceptions
+from flask import Flask, request, Response, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.targets import BaseTarget, ValueTarget
+
+class OrJSONProvider(JSONProvider):
+    """
+    JSON provider backed by orjson's C encoder. jsonify and the error
+    responses go through this with no client-visible change.
+    """
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = OrJSONProvider(app)
+
+# Deflate level for the response zip. Level 1 is several times faster than
+# zlib's default (6) on source text, at a ~10-15% ratio cost -- the archive
+# is downloaded once and discarded, so favor speed.
+ZIP_LEVEL = int(os.environ.get("ZIP_LEVEL", "1"))
+
+# Per-attempt deadline for Gemini calls, in seconds. Without one, a
+# single slow call stalls a worker indefinitely; set this just above the
+# median latency and let the retry loop absorb the tail.
+GEMINI_TIMEOUT = float(os.environ.get("GEMINI_TIMEOUT", "20"))
+
+# How many Gemini calls may be in flight at once. Files are fixed with
+# one request each, so this bounds both rate-limit pressure and memory.
+GEMINI_CONCURRENCY = int(os.environ.get("GEMINI_CONCURRENCY", "10"))
+
+# In-process cache of Gemini responses keyed by file content + settings.
+# Iterative fixing resubmits mostly-identical repos, so a hit collapses
+# the dominant cost (the LLM call) to a dict lookup.
+GEMINI_CACHE_SIZE = int(os.environ.get("GEMINI_CACHE_SIZE", "1024"))
+_gemini_cache = {}
+# gthread workers share the cache across threads; serialize evict+insert
+_gemini_cache_lock = threading.Lock()
+
+
+# Matches one START_FILE/END_FILE block in a Gemini response. Compiled
+# once at import so every parse is a single linear scan.
+_FILE_RE = re.compile(r'START_FILE:\s*(.+?)\n(.*?)\nEND_FILE', re.DOTALL)
+
+
+def _cache_key(path, content, instructions, opt_lint, opt_comments):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(path.encode('utf-8'))
+    h.update(b'\0')
+    h.update(content.encode('utf-8'))
+    h.update(b'\0')
+    h.update(instructions.encode('utf-8'))
+    h.update(bytes([opt_lint, opt_comments]))
+    return h.digest()
+
+# Extensions treated as text and sent to Gemini. Anything else (images,
+# fonts, compiled artifacts) is kept as raw bytes, skips the UTF-8
+# decode/encode roundtrip entirely, and is echoed into the output zip.
+TEXT_EXTS = {
+    '.py', '.js', '.ts', '.tsx', '.jsx', '.json', '.md', '.html', '.css',
+    '.yml', '.yaml', '.toml', '.txt', '.go', '.rs', '.java', '.c', '.h',
+    '.cpp',
+}
+
+# Prefer ISA-L's SIMD-accelerated deflate and CRC32 over the bundled zlib.
+# Fall back to the stdlib if the wheel is unavailable on this platform.
+try:
+    from isal import isal_zlib
+
+    _crc32 = isal_zlib.crc32
+
+    def _deflate_obj():
+        # ISA-L only has levels 0-3
+        return isal_zlib.compressobj(
+            min(ZIP_LEVEL, 3), isal_zlib.DEFLATED, -isal_zlib.MAX_WBITS)
+except ImportError:
+    _crc32 = zlib.crc32
+
+    def _deflate_obj():
+        return zlib.compressobj(ZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+
+def _deflated_entry(path, data):
+    """
+    Compresses one zip entry; runs in the thread pool (the deflate C code
+    releases the GIL, so entries genuinely compress in parallel).
+    """
+    comp = _deflate_obj()
+    return (path, _crc32(data) & 0xffffffff, len(data),
+            comp.compress(data) + comp.flush(), 8)
+
+
+def _stored_entry(path, data):
+    return (path, _crc32(data) & 0xffffffff, len(data), data, 0)
+
+
+def _zip_exceeds_limits(entries):
+    """
+    True if the archive would overflow the classic (non-ZIP64) fields
+    _iter_zip writes: the entry count, a per-entry size, or the central
+    directory offset. Checked before streaming starts so an oversized
+    result fails cleanly instead of truncating mid-response.
+    """
+    if len(entries) > 0xffff:
+        return True
+    offset = 0
+    for name, _, usize, payload, _ in entries:
+        if usize > 0xffffffff or len(payload) > 0xffffffff:
+            return True
+        offset += 30 + len(name.encode('utf-8')) + len(payload)
+    return offset > 0xffffffff
+
+
+def _iter_zip(entries, modified_at):
+    """
+    Streams a zip archive from precompressed entries.
+
+    Each entry is (name, crc, uncompressed_size, payload, method), where
+    payload is a raw deflate stream for method 8 or the original bytes
+    for method 0 (stored). Writing the format by hand is what lets the
+    deflate work happen up front across cores -- zipfile and stream-zip
+    are both single-threaded writers that compress inline.
+    """
+    dosdate = ((modified_at.year - 1980) << 9 | modified_at.month << 5
+               | modified_at.day)
+    dostime = (modified_at.hour << 11 | modified_at.minute << 5
+               | modified_at.second // 2)
+    central = []
+    offset = 0
+
+    for name, crc, usize, payload, method in entries:
+        raw_name = name.encode('utf-8')
+        # Local file header; flag 0x0800 marks the name as UTF-8
+        header = struct.pack(
+            '<LHHHHHLLLHH', 0x04034b50, 20, 0x0800, method,
+            dostime, dosdate, crc, len(payload), usize, len(raw_name), 0)
+        yield header
+        yield raw_name
+        yield payload
+        # Central directory entry (version-made-by 0x031e = unix, 2.0)
+        central.append(struct.pack(
+            '<LHHHHHHLLLHHHHHLL', 0x02014b50, 0x031e, 20, 0x0800, method,
+            dostime, dosdate, crc, len(payload), usize, len(raw_name),
+            0, 0, 0, 0, 0o100600 << 16, offset))
+        central.append(raw_name)
+        offset += len(header) + len(raw_name) + len(payload)
+
+    cd_size = 0
+    for chunk in central:
+        cd_size += len(chunk)
+        yield chunk
+    # End of central directory record
+    yield struct.pack('<LHHHHLLH', 0x06054b50, 0, 0, len(entries),
+                      len(entries), cd_size, offset, 0)
 
 # --- UPDATED CORS CONFIGURATION ---
 CORS(app, resources={
@@ -17,108 +182,186 @@ CORS(app, resources={
 })
 # --- END OF UPDATE ---
 
-# --- MODIFICATION: Initialize model to None ---
-model = None
-# --- END MODIFICATION ---
-
-# Configure the Gemini API
-try:
+@lru_cache(maxsize=1)
+def get_model():
+    """
+    Configures the Gemini SDK and builds the GenerativeModel exactly once
+    per process, so reloads and test imports don't re-pay configuration.
+    """
     GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
     if not GEMINI_API_KEY:
         # This is the most likely error
         raise ValueError("GEMINI_API_KEY environment variable not set or empty.")
-    
+
     genai.configure(api_key=GEMINI_API_KEY)
     model = genai.GenerativeModel('gemini-1.5-flash')
     print("Gemini model initialized successfully.") # Added log
+    return model
 
-except Exception as e:
-    # This will now print the *real* error to your server logs
-    print(f"CRITICAL ERROR: Failed to configure Gemini: {e}")
-    print("The 'model' variable is NOT defined. All API calls will fail.")
+class _FileDictTarget(BaseTarget):
+    """Collects the repeated ``files`` field into a dict of raw bytes.
 
-def call_gemini_to_fix_code(files_data, instructions, opt_lint, opt_comments):
+    The parser reuses one target for every part with the same field name,
+    calling start/finish around each file, so we key the accumulated bytes
+    by ``multipart_filename`` (the webkitRelativePath sent by the frontend).
+    """
+
+    def __init__(self, files):
+        super().__init__()
+        self._files = files
+        self._buffer = bytearray()
+
+    def on_start(self):
+        self._buffer = bytearray()
+
+    def on_data_received(self, chunk):
+        self._buffer += chunk
+
+    def on_finish(self):
+        if self.multipart_filename:
+            self._files[self.multipart_filename] = bytes(self._buffer)
+
+
+def _build_prompt(path, content, instructions, opt_lint, opt_comments):
     """
-    Uses the Gemini API to analyze and fix a set of files.
+    Builds the fix prompt for a single file.
     """
-    # --- MODIFICATION: Check if model is initialized ---
-    if model is None:
-        print("Error: call_gemini_to_fix_code called, but model is None.")
-        # This new error message will appear in the frontend popup
-        return {"error": "Server Error: The AI model failed to initialize. Check server logs for details."}
-    # --- END MODIFICATION ---
+    # Assemble into a bytearray rather than a list-of-str + join: this
+    # avoids re-scanning the file content through an intermediate str.
+    buf = bytearray()
+    buf += (
+        "You are an expert AI code-fixing agent, BugFixer.ai.\n"
+        "A user has uploaded a project; you are given one file from it.\n"
+        "Your task is to fix the bug(s) described in their instructions, preserving the exact file path.\n"
+        "\n--- USER INSTRUCTIONS ---\n"
+        f"{instructions or 'No specific instructions provided. Please analyze and fix any obvious bugs.'}\n"
+        "\n--- OPTIONAL OPTIMIZATIONS ---\n"
+        f"- Fix Linting Errors: {'Yes' if opt_lint else 'No'}\n"
+        f"- Add Explanatory Comments: {'Yes' if opt_comments else 'No'}\n"
+        "\n--- PROJECT FILE ---"
+    ).encode('utf-8')
 
-    if not files_data:
-        return {}
+    buf += b"\n\n--- File: "
+    buf += path.encode('utf-8')
+    buf += b" ---\n"
+    buf += content.encode('utf-8')
+    buf += b"\n--- End of File ---"
 
-    # --- Create a single, powerful prompt for Gemini ---
-    prompt_parts = [
-        "You are an expert AI code-fixing agent, BugFixer.ai.",
-        "A user has uploaded a project with the following files and structure.",
-        "Your task is to fix the bug(s) described in their instructions, preserving the exact file structure.",
-        "\n--- USER INSTRUCTIONS ---",
-        instructions or "No specific instructions provided. Please analyze and fix any obvious bugs.",
-        "\n--- OPTIONAL OPTIMIZATIONS ---",
-        f"- Fix Linting Errors: {'Yes' if opt_lint else 'No'}",
-        f"- Add Explanatory Comments: {'Yes' if opt_comments else 'No'}",
-        "\n--- PROJECT FILES ---"
-    ]
-
-    # Add file contents to the prompt
-    for path, content in files_data.items():
-        prompt_parts.append(f"\n--- File: {path} ---")
-        prompt_parts.append(content)
-        prompt_parts.append("--- End of File ---")
-    
-    prompt_parts.append("\n--- YOUR TASK ---")
-    prompt_parts.append(
-        "Generate the corrected code for all files that need changes. "
-        "For each file you modify, you MUST provide the output in the following format, "
-        "and only this format:"
-    )
-    prompt_parts.append(
+    buf += (
+        "\n\n--- YOUR TASK ---\n"
+        "Generate the corrected code if this file needs changes. "
+        "If you modify the file, you MUST provide the output in the following format, "
+        "and only this format:\n"
         "START_FILE: [full/path/to/file.js]\n"
         "[... the complete, corrected code for this file ...]\n"
-        "END_FILE"
+        "END_FILE\n"
+        "If the file does not need any changes, return an empty response."
+    ).encode('utf-8')
+
+    # The SDK wants str, so decode exactly once at the end
+    return buf.decode('utf-8')
+
+
+def _fix_one_file(model, path, content, instructions, opt_lint, opt_comments):
+    """
+    Sends one file to Gemini and returns the raw response text. Runs on
+    the worker pool; the network wait releases the GIL.
+    """
+    key = _cache_key(path, content, instructions, opt_lint, opt_comments)
+    cached = _gemini_cache.get(key)
+    if cached is not None:
+        return cached
+
+    prompt = _build_prompt(path, content, instructions, opt_lint, opt_comments)
+
+    gen_config = genai.types.GenerationConfig(
+        max_output_tokens=8192,
+        temperature=0.2,
     )
-    prompt_parts.append("If a file does not need any changes, do not include it in your response.")
 
-    prompt = "\n".join(prompt_parts)
-    
-    print("--- Sending prompt to Gemini ---")
-    print("--------------------------------")
+    # Retry only the timeout/unavailable tail, with exponential backoff
+    for attempt in range(3):
+        try:
+            response = model.generate_content(
+                prompt,
+                generation_config=gen_config,
+                request_options={'timeout': GEMINI_TIMEOUT},
+            )
+            try:
+                text = response.text
+            except ValueError:
+                # A no-change file legitimately comes back as an empty
+                # candidate (the prompt asks for an empty response), and
+                # .text raises on a candidate with no parts -- treat it
+                # as "no fix" instead of failing the whole request.
+                text = ""
+            with _gemini_cache_lock:
+                if _gemini_cache and len(_gemini_cache) >= GEMINI_CACHE_SIZE:
+                    # Evict the oldest insertion (dicts keep insert order)
+                    _gemini_cache.pop(next(iter(_gemini_cache)), None)
+                _gemini_cache[key] = text
+            return text
+        except (google_exceptions.DeadlineExceeded,
+                google_exceptions.ServiceUnavailable) as retry_err:
+            if attempt == 2:
+                raise
+            wait = 2 ** attempt
+            print(f"Gemini call for {path} failed ({retry_err}); retrying in {wait}s")
+            time.sleep(wait)
 
-    try:
-        response = model.generate_content(prompt)
-        ai_response_text = response.text
-        
-        # --- Parse the AI's response ---
-        fixed_files = {}
-        file_blocks = ai_response_text.split("START_FILE: ")
-        
-        for block in file_blocks:
-            if not block.strip():
-                continue
-                
-            parts = block.split("\n", 1)
-            if len(parts) < 2:
-                continue
-                
-            file_path = parts[0].strip()
-            # Find the end of the code
-            if "END_FILE" in parts[1]:
-                code_content = parts[1].rsplit("END_FILE", 1)[0].strip()
-                fixed_files[file_path] = code_content
-            else:
-                print(f"Warning: Could not find END_FILE for {file_path}")
-
-        print(f"Gemini fixed {len(fixed_files)} files.")
-        return fixed_files
 
+def call_gemini_to_fix_code(files_data, instructions, opt_lint, opt_comments):
+    """
+    Uses the Gemini API to analyze and fix a set of files, one concurrent
+    request per file so prompt size stays O(file) and slow calls don't
+    block the rest of the repo.
+    """
+    try:
+        model = get_model()
     except Exception as e:
+        # This will now print the *real* error to your server logs
+        print(f"CRITICAL ERROR: Failed to configure Gemini: {e}")
+        # This error message will appear in the frontend popup
+        return {"error": "Server Error: The AI model failed to initialize. Check server logs for details."}
+
+    if not files_data:
+        return {}
+
+    print(f"--- Sending {len(files_data)} files to Gemini ---")
+
+    # Sync calls on a bounded thread pool: the SDK's sync gRPC channel is
+    # shared and thread-safe, so this parallelizes the network wait
+    # without tying anything to a per-request event loop.
+    with ThreadPoolExecutor(max_workers=GEMINI_CONCURRENCY) as ex:
+        futures = [
+            ex.submit(_fix_one_file, model, path, content,
+                      instructions, opt_lint, opt_comments)
+            for path, content in files_data.items()
+        ]
+        responses = []
+        errors = []
+        # Collect every future so siblings always run to completion
+        for future in futures:
+            try:
+                responses.append(future.result())
+            except Exception as e:
+                errors.append(e)
+
+    if errors:
         # This will now catch runtime errors from Gemini
-        print(f"Error calling Gemini API: {e}")
-        return {"error": f"Error calling Gemini: {e}"}
+        print(f"Error calling Gemini API: {errors[0]}")
+        return {"error": f"Error calling Gemini: {errors[0]}"}
+
+    # --- Parse the AI's responses ---
+    # One pass per response with the pre-compiled pattern instead of the
+    # old split/rsplit dance and its intermediate string copies.
+    fixed_files = {}
+    for ai_response_text in responses:
+        for match in _FILE_RE.finditer(ai_response_text):
+            fixed_files[match.group(1).strip()] = match.group(2).strip()
+
+    print(f"Gemini fixed {len(fixed_files)} files.")
+    return fixed_files
 
 
 @app.route('/api/fix', methods=['POST', 'OPTIONS'])
@@ -128,24 +371,50 @@ def fix_code():
         return _build_cors_preflight_response()
     
     if request.method == 'POST':
-        if 'files' not in request.files:
+        # Parse the multipart body straight off the wire instead of letting
+        # werkzeug buffer every file (to disk past 500KB) before we copy it
+        # again with file.read().
+        raw_files = {}
+        instructions_target = ValueTarget()
+        lint_target = ValueTarget()
+        comments_target = ValueTarget()
+
+        # A missing multipart Content-Type or boundary makes the parser
+        # raise; answer with the same 400 the old request.files guard gave
+        try:
+            parser = StreamingFormDataParser(headers=request.headers)
+            parser.register('files', _FileDictTarget(raw_files))
+            parser.register('instructions', instructions_target)
+            parser.register('optLint', lint_target)
+            parser.register('optComments', comments_target)
+
+            while chunk := request.stream.read(65536):
+                parser.data_received(chunk)
+        except Exception as e:
+            print(f"Malformed multipart body: {e}")
             return jsonify({"error": "No files part"}), 400
 
-        files = request.files.getlist('files')
-        instructions = request.form.get('instructions', '')
-        _lint = request.form.get('optLint')
-        opt_lint = _lint == '1' if _lint is not None else False
-        _comments = request.form.get('optComments')
-        opt_comments = _comments == '1' if _comments is not None else True
+        if not raw_files:
+            return jsonify({"error": "No files part"}), 400
 
+        instructions = instructions_target.value.decode('utf-8', errors='replace')
+        opt_lint = lint_target.value == b'1'
+        opt_comments = comments_target.value != b'0'
 
         original_files = {}
-        for file in files:
-            # file.filename is the webkitRelativePath we sent
+        binary_files = {}
+        for path, data in raw_files.items():
+            # The key is the webkitRelativePath we sent
+            if os.path.splitext(path)[1].lower() not in TEXT_EXTS:
+                binary_files[path] = data
+                continue
             try:
-                original_files[file.filename] = file.read().decode('utf-8')
+                original_files[path] = data.decode('utf-8')
             except UnicodeDecodeError:
-                print(f"Skipping file {file.filename} due to decode error")
+                # Text extension but not UTF-8: treat it as binary so the
+                # request survives and the file is still echoed back.
+                print(f"Treating file {path} as binary due to decode error")
+                binary_files[path] = data
 
         if not original_files:
             return jsonify({"error": "No valid text files found to process."}), 400
@@ -156,23 +425,45 @@ def fix_code():
         if "error" in fixed_files_map:
             return jsonify(fixed_files_map), 500
 
-        # Create a new zip file in memory
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-            # Loop through original files to preserve all of them
-            for path, content in original_files.items():
-                # If the AI provided a fix, use it.
-                # Otherwise, write the original file back.
-                final_content = fixed_files_map.get(path, content)
-                zf.writestr(path, final_content.encode('utf-8'))
-
-        zip_buffer.seek(0)
-        
-        return send_file(
-            zip_buffer,
+        changed = {path: fixed_files_map[path] for path in original_files
+                   if path in fixed_files_map}
+        # Small manifest so clients can tell what actually changed; built
+        # from the filtered dict so hallucinated paths Gemini invented
+        # (and which aren't in the archive as fixes) are not listed
+        manifest = orjson.dumps({"modified": sorted(changed)})
+
+        # Don't collide with a repo that ships its own root MANIFEST.json
+        manifest_name = 'MANIFEST.json'
+        if manifest_name in raw_files:
+            manifest_name = '.bugfixer-manifest.json'
+
+        # Deflate the changed entries across cores, then stream the
+        # archive from the precompressed payloads.
+        to_deflate = []
+        if manifest_name not in raw_files:
+            to_deflate.append((manifest_name, manifest))
+        to_deflate += [(path, content.encode('utf-8'))
+                       for path, content in changed.items()]
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            entries = list(ex.map(lambda item: _deflated_entry(*item),
+                                  to_deflate))
+
+        # Unchanged files are just being echoed back -- store them instead
+        # of paying deflate for identical bytes
+        entries += [_stored_entry(path, content.encode('utf-8'))
+                    for path, content in original_files.items()
+                    if path not in changed]
+        # Binary files were never decoded; echo the raw bytes back
+        entries += [_stored_entry(path, data)
+                    for path, data in binary_files.items()]
+
+        if _zip_exceeds_limits(entries):
+            return jsonify({"error": "Result is too large for a zip archive (ZIP64 is not supported)."}), 413
+
+        return Response(
+            _iter_zip(entries, datetime.now()),
             mimetype='application/zip',
-            as_attachment=True,
-            download_name='fixed_repo.zip'
+            headers={'Content-Disposition': 'attachment; filename=fixed_repo.zip'}
         )
 
 # --- NEW HELPER FUNCTIONS FOR CORS ---
@@ -184,4 +475,6 @@ def _build_cors_preflight_response():
     return response
 
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
+    # Local development only -- production runs under gunicorn (Dockerfile)
+    app.run(debug=bool(os.environ.get("FLASK_DEBUG")), host="0.0.0.0",
+            port=int(os.environ.get("PORT", 8080)))